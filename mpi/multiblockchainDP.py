@@ -1,25 +1,35 @@
 '''
 Description: Multiple blockchains with multiple nodes to run user-defined number of clients and transactions.
-Run code: mpirun -np <#nodes> python3 multiblockchainDP.py #clients #transactions
+Run code: mpirun -np <#nodes> python3 multiblockchainDP.py #clients #transactions [#blockchains]
+#blockchains defaults to 3
 '''
 
+import atexit
 import binascii
+import collections
+import concurrent.futures
 import Crypto.Random
 import datetime
 import hashlib
-import json
 import logging
+import multiprocessing
+import numpy as np
+import orjson
 import os
 import pickle
-import pylab as pl
-import random
 import string
+import struct
 import sys
 from Crypto.Hash import SHA
 from Crypto.PublicKey import RSA
 from Crypto.Signature import PKCS1_v1_5
 from mpi4py import MPI
 
+MPI.pickle.PROTOCOL = 5 # used by the lowercase (pickle based) mpi4py calls
+# Transaction times are naive local datetimes; counting microseconds from a naive epoch encodes
+#   them without consulting the host's timezone
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
 
 class Client:
     """
@@ -30,6 +40,10 @@ class Client:
     _private_key : RSA
     _public_key : RSA
     _signer : PKCS1_v1_5
+    _public_der : bytes
+        DER encoded public key
+    _identity : str
+        hex encoded DER public key, exported once at creation
     name : str
         used to identify the Client
 
@@ -37,13 +51,24 @@ class Client:
     -------
     sign()
         Returns the Client's private key
+    to_public()
+        Returns the ClientPublic view of the Client
+
+    A pickled Client is unpickled as its ClientPublic, so the private key stays on the node
+    that created it
     """
 
-    def __init__(self, name):
-        random = Crypto.Random.new().read
-        self._private_key = RSA.generate(1024, random)
+    def __init__(self, name, private_key=None):
+        # only keys generated in pool workers arrive DER encoded; importing one re-runs the key checks,
+        #   so a key generated here is used as is
+        if private_key is None:
+            self._private_key = RSA.generate(1024, _RNG.read)
+        else:
+            self._private_key = RSA.importKey(private_key)
         self._public_key = self._private_key.publickey()
         self._signer = PKCS1_v1_5.new(self._private_key)
+        self._public_der = self._public_key.exportKey(format='DER')
+        self._identity = binascii.hexlify(self._public_der).decode('ascii')
         self.name = name
     
     def sign(self):
@@ -51,12 +76,57 @@ class Client:
 
     @property
     def identity(self):
-        return binascii.hexlify(self._public_key.exportKey(format='DER')).decode('ascii')
+        return self._identity
+
+    def to_public(self):
+        return ClientPublic(self.name, self._public_der)
+
+    def __reduce__(self):
+        return ClientPublic, (self.name, self._public_der)
+
+    def __setstate__(self, state):
+        # only Clients pickled before __reduce__ existed get here, with their full __dict__ and
+        #   without the cached public key encodings
+        self.__dict__.update(state)
+        self._public_der = self._public_key.exportKey(format='DER')
+        self._identity = binascii.hexlify(self._public_der).decode('ascii')
     
     def __eq__ (self, name):
         return self.name == name
 
 
+class ClientPublic:
+    """
+    Class for the public part of a Client, which is all other nodes need
+
+    Attributes
+    ----------
+    name : str
+        used to identify the Client
+    _public_der : bytes
+        DER encoded public key
+    _identity : str
+        hex encoded DER public key
+    """
+
+    __slots__ = ('name', '_public_der', '_identity')
+
+    def __init__(self, name, public_der):
+        self.name = name
+        self._public_der = public_der
+        self._identity = binascii.hexlify(public_der).decode('ascii')
+
+    @property
+    def identity(self):
+        return self._identity
+
+    def __eq__ (self, name):
+        return self.name == name
+
+    def __reduce__(self):
+        return ClientPublic, (self.name, self._public_der)
+
+
 class Transaction:
     """
     Class used to represent transactions to be included in blocks
@@ -65,9 +135,9 @@ class Transaction:
 
     Attributes
     ----------
-    sender : Client
+    sender : Client or ClientPublic
         originator of the Transaction
-    recipient : Client
+    recipient : Client or ClientPublic
         recipient of the Transaction
     value : bool, int, float
         the datatype changes based on the blockchain
@@ -80,6 +150,8 @@ class Transaction:
         Converts the Transaction's data to dictionary
     sign_transaction()
         Verifies the sender of the Transaction
+    _canonical_bytes()
+        Encodes the Transaction's data as the bytes that are signed
     display_transaction()
         Prints the data in the Transaction
     """
@@ -98,15 +170,30 @@ class Transaction:
             'time': self.time
         }
 
+    def __getstate__(self):
+        return (self.sender, self.recipient, self.value, self.time)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict): # pickled before the state became a tuple
+            self.__dict__.update(state)
+            return
+        self.sender, self.recipient, self.value, self.time = state
+
     def sign_transaction(self, signer):
         """
         Uses sender's private key to sign transaction
         """
         if (signer.sign() == self.sender.sign()):
-            private_key = self.sender._private_key
-            signer = PKCS1_v1_5.new(private_key)
-            h = SHA.new(str(self.to_dict()).encode('utf8'))
-            return binascii.hexlify(signer.sign(h)).decode('ascii')
+            h = SHA.new(self._canonical_bytes())
+            return binascii.hexlify(self.sender._signer.sign(h)).decode('ascii')
+
+    def _canonical_bytes(self):
+        """
+        Fixed layout byte encoding of the Transaction that is signed
+        """
+        return (self.sender.identity.encode('ascii') + self.recipient.identity.encode('ascii')
+                + struct.pack('<d', float(self.value))
+                + struct.pack('<q', (self.time - _EPOCH) // _MICROSECOND))
 
     def display_transaction(self):
         """
@@ -133,7 +220,7 @@ class MemPool:
     
     Attributes
     ----------
-    transactions : list of Transactions
+    transactions : deque of Transactions
         the queue of transactions to be added
 
     Methods
@@ -147,7 +234,7 @@ class MemPool:
     """
     
     def __init__(self):
-        self.transactions = []
+        self.transactions = collections.deque()
     def display_mempool(self):
         if len(self.transactions) > 0:
             for transaction in self.transactions:
@@ -157,9 +244,7 @@ class MemPool:
     def add_transaction(self, transaction):
         self.transactions.append(transaction)
     def pull_transaction(self):
-        nextTransaction = self.transactions[0]
-        self.transactions.pop(0)
-        return nextTransaction
+        return self.transactions.popleft()
     def get_size(self):
         return len(self.transactions)
 
@@ -180,6 +265,10 @@ class Block:
         the mined value which satisfies the blockchain's difficulty value
     block_height : int
         the height of the Block to be added to the blockchain
+    content_hash_base : str
+        SHA-256 of the previous Block's hash and the Transactions, used as the mining prefix
+    content_hash : str
+        SHA-256 of content_hash_base and the nonce, which the next Block links to
 
     Methods
     -------
@@ -196,6 +285,8 @@ class Block:
         self.previous_block_hash = ""
         self.nonce = ""
         self.block_height = 0
+        self._base_hash = None
+        self._hash = None
     def display_block(self):
         print ("Block #" + str(self.block_height))
         print ("--------")
@@ -203,11 +294,38 @@ class Block:
             transaction.display_transaction()
     def add_transaction(self, transaction):
         self.verified_transactions.append(transaction)
+        self._base_hash = None
+        self._hash = None
     def to_dict(self) -> dict:
         returnDict = {}
         for x, transaction in enumerate(self.verified_transactions):
             returnDict[x] = transaction.to_dict()
         return returnDict
+    @property
+    def content_hash_base(self) -> str:
+        # computed once per Block, since the same value prefixes every nonce attempt
+        # the Transactions enter as their fixed layout signing bytes; unlike pickle output, these
+        #   do not depend on the pickle protocol, the Python version or object identity
+        if self._base_hash is None:
+            content = self.previous_block_hash.encode('ascii') + b''.join(
+                transaction._canonical_bytes() for transaction in self.verified_transactions)
+            self._base_hash = sha256(content)
+        return self._base_hash
+    @property
+    def content_hash(self) -> str:
+        # only valid once the nonce has been mined
+        if self._hash is None:
+            self._hash = sha256((self.content_hash_base + self.nonce).encode('ascii'))
+        return self._hash
+    def __getstate__(self):
+        return (self.verified_transactions, self.previous_block_hash, self.nonce, self.block_height)
+    def __setstate__(self, state):
+        self._base_hash = None
+        self._hash = None
+        if isinstance(state, dict): # pickled before the state became a tuple
+            self.__dict__.update(state)
+            return
+        self.verified_transactions, self.previous_block_hash, self.nonce, self.block_height = state
 
 
 class Blockchain:
@@ -253,7 +371,7 @@ class Blockchain:
         Adds a block to the blockchain and appends it to file if it was not read from file
         """
         self.chain.append(newBlock)
-        self.latest_block_hash = hash(newBlock)
+        self.latest_block_hash = newBlock.content_hash
         self.chainLength += 1
         newBlock.block_height = self.chainLength
         # maybe add logic to check hashes (verify before adding?)
@@ -273,7 +391,7 @@ class Blockchain:
         Iterates over the blockchain from genesis to latest and checks hashes
         """
         for i in range(0, self.chainLength-1):
-            if (hash(self.chain[i]) != self.chain[i+1].previous_block_hash):
+            if (self.chain[i].content_hash != self.chain[i+1].previous_block_hash):
                 return False
         return True
     def read_blockchain(self, blockchain_data):
@@ -304,9 +422,10 @@ class Blockchain:
         """
         Writes all individual blocks to file
         """
+        close_blockchain_file() # buffered appends must not land after the rewrite
         with open(blockchain_data, 'wb') as file:
             for i, block in enumerate(self.chain):
-                pickle.dump(self.chain[i], file)
+                pickle.dump(self.chain[i], file, protocol=5)
 
 
 class Miner:
@@ -322,8 +441,8 @@ class Miner:
     -------
     mine(message, difficulty)
         Hashes a block until a valid (based on difficulty) nonce is found
-    broadcast_block(block, local)
-        Broadcasts or receives a new block based on it the node mined the block
+    broadcast_block(block, minerRank)
+        Broadcasts the new block from the node that mined it to all other nodes
     """
     
     def __init__(self) -> None:
@@ -331,65 +450,157 @@ class Miner:
     def mine(message, difficulty = 1):
         """
         mines a block based on a given difficulty value
+        returns the winning digest and the subcomm rank of the node that found it
         """
         assert difficulty >= 1, "Difficulty is invalid"
-        prefix = '0' * difficulty
-        i = 0
-        found = False
-        foundLocal = False
-        while found is False:
-            # checks to see if other process has found digest
-            probe = subcomm.iprobe()
-            if probe:
-                digest = subcomm.recv()
-                found = True
-            else:
-                # if the digist/nonce has not been found, node tries mining it
-                digest = sha256(str(hash(message)) + str(i))
-                if (digest.startswith(prefix)):
-                    found = True
-                    foundLocal = True
-                    # sends digest to all other processes
-                    for j in range(subcommSize):
-                        if j == subcommRank:
-                            continue
-                        subcomm.send(digest, dest=j, tag=NONCE_TAG)
-            i += 1
-        return digest, foundLocal
-    def broadcast_block(block, local) -> None:
+        target = 1 << (256 - 4 * difficulty) # digests below target start with difficulty zeros
+        # fixed part of every hashed message; the rank keeps each node's nonces distinct
+        base = (message.content_hash_base + ':' + str(subcommRank) + ':').encode('ascii')
+        midstate = hashlib.sha256(base) # hash state after the fixed part, absorbed once per block
+        nonce = bytearray(b'0') # ASCII decimal nonce, updated in place
+        report = np.empty(2, 'i4')
+        election = np.empty(2, 'i4')
+        digest = search_nonces(midstate, nonce, NONCE_CHUNK, target)
+        while True:
+            # every node reports after each chunk; the lowest rank holding a digest wins
+            report[:] = (digest is None, subcommRank)
+            request = Comms.subcomm.Iallreduce([report, MPI.INT_INT], [election, MPI.INT_INT],
+                                               op=MPI.MINLOC)
+            # hashes the next chunk while the election is in flight
+            nextDigest = None
+            if digest is None:
+                nextDigest = search_nonces(midstate, nonce, NONCE_CHUNK, target)
+            request.Wait()
+            missing, winner = election.tolist()
+            if not missing:
+                break
+            digest = nextDigest
+        if winner == subcommRank:
+            _nonce_buf[:] = np.frombuffer(digest.encode('ascii'), 'u1')
+        Comms.subcomm.Bcast([_nonce_buf, MPI.BYTE], root=winner)
+        return _nonce_buf.tobytes().decode('ascii'), winner
+    def broadcast_block(block, minerRank) -> None:
         """
-        Broadcasts or receives a new block based on it the node mined the block
+        Broadcasts the new block from the node that mined it to all other nodes
         """
         global blockchain
-        if local is True:
-            blockchain.add_block(block, False)
-            # sends block to all blockchain nodes
-            for node in range (subcommSize):
-                if node == subcommRank:
-                    continue
-                subcomm.send(block, dest=node, tag=BLOCK_TAG)
-        else:
-            # wait for block message
-            status = MPI.Status()
-            receivedBlock = subcomm.recv(status=status, tag=BLOCK_TAG)
-            blockchain.add_block(receivedBlock, False)
-        subcomm.barrier() # waits until all nodes have received block
+        # every node already knows the miner from Miner.mine, so a single tree broadcast replaces
+        # the per-node sends and the barrier that waited for them
+        block = Comms.subcomm.bcast(block if subcommRank == minerRank else None, root=minerRank)
+        blockchain.add_block(block, False)
+
+
+# Crypto.Random.new() is a stateless reader of os.urandom, so one instance serves every key the
+#   process generates, including in forked workers
+_RNG = Crypto.Random.new()
+
+
+def generate_key(_=None):
+    """
+    Generates a 1024 bit RSA key in a create_clients worker and returns it DER encoded so it can be
+    passed back to the parent process
+    """
+    return RSA.generate(1024, _RNG.read).exportKey(format='DER')
+
+
+def create_clients(numClients):
+    """
+    Creates numClients Clients, generating their keys in parallel across the CPU cores once there
+    are at least PARALLEL_CLIENTS of them
+
+    The workers are forked from an MPI process that is already initialized, which MPI does not
+    support and some transports warn about or break on, so smaller runs stay serial. Only the fork
+    start method is used: spawn and forkserver workers would re-import this module and run its
+    top level, including Comms.create and comm.barrier()
+    """
+    if numClients < PARALLEL_CLIENTS or 'fork' not in multiprocessing.get_all_start_methods():
+        return [Client(x) for x in range(numClients)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count(),
+                                                mp_context=multiprocessing.get_context('fork')) as executor:
+        keys = executor.map(generate_key, range(numClients),
+                            chunksize=max(1, numClients // (4 * os.cpu_count())))
+        return [Client(x, key) for x, key in enumerate(keys)]
 
 
 def sha256(message):
-    return hashlib.sha256(message.encode('ascii')).hexdigest()
+    """
+    Returns the hex digest of a bytes message
+    hashlib uses OpenSSL, which selects the SHA extensions at runtime when the CPU has them
+    """
+    return hashlib.sha256(message).hexdigest()
+
+
+def increment_nonce(nonce):
+    """
+    Adds one to the ASCII decimal nonce stored in a bytearray without creating new objects
+    The buffer only grows when the nonce gains a digit
+    """
+    i = len(nonce) - 1
+    while i >= 0:
+        if nonce[i] != 0x39: # '9'
+            nonce[i] += 1
+            return
+        nonce[i] = 0x30 # '0'
+        i -= 1
+    nonce.insert(0, 0x31) # '1'
+
+
+def search_nonces(midstate, nonce, count, target):
+    """
+    Hashes count consecutive nonces, advancing nonce after each attempt
+    midstate is a sha256 object that has already absorbed the fixed prefix, so each attempt only
+    copies its state and hashes the nonce digits
+    Returns the hex digest of the first hash below target, or None if no nonce in the range matches
+    """
+    for _ in range(count):
+        h = midstate.copy()
+        h.update(nonce)
+        digest = h.digest()
+        if int.from_bytes(digest, 'big') < target:
+            return digest.hex()
+        increment_nonce(nonce)
+    return None
 
 
 def check_cla() -> bool:
-    return len(sys.argv) == 3
+    return len(sys.argv) in (3, 4) and numBlockchains is not None
+
+
+def read_num_blockchains():
+    """
+    Returns the optional #blockchains argument, 3 when it is not given, or None when it is not a
+    positive integer so check_cla can print the usage line instead of every rank crashing
+    """
+    if len(sys.argv) != 4:
+        return 3
+    try:
+        numBlockchains = int(sys.argv[3])
+    except ValueError:
+        return None
+    return numBlockchains if numBlockchains >= 1 else None
 
 
 def persist_block(newBlock):
     """
     Appends a pickled block to file
+    The file is opened once and flushed every PERSIST_FLUSH blocks instead of reopened per block
     """
-    with open(blockchain_data, 'ab') as file:
-        pickle.dump(newBlock, file)
+    global blockchain_file
+    if blockchain_file is None:
+        blockchain_file = open(blockchain_data, 'ab', buffering=1 << 20)
+    pickle.dump(newBlock, blockchain_file, protocol=5)
+    if newBlock.block_height % PERSIST_FLUSH == 0:
+        blockchain_file.flush()
+
+
+def close_blockchain_file():
+    """
+    Flushes and closes the blockchain data file opened by persist_block
+    """
+    global blockchain_file
+    if blockchain_file is not None:
+        blockchain_file.close()
+        blockchain_file = None
 
 
 def pickle_clients(clientList):
@@ -424,34 +635,30 @@ def persist_to_json(data):
     """
     Writes a dictionary object to the node's blockchain data file
     """
-    json_object = json.dumps(data, indent=4, sort_keys=True, default=str)
-    with open(blockchain_json, 'w') as file:
+    # orjson formats datetimes natively; integer block/transaction keys keep their numeric order
+    json_object = orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    with open(blockchain_json, 'wb') as file:
         file.write(json_object)
 
 
 def synchronize_ledgers():
     """
-    Node 0 sends its ledger to any node with a different blockchain length
+    The node with the longest ledger sends it to every node with a shorter blockchain
     """
     global blockchain
     localLength = blockchain.get_chain_length()
-    ledgerLengths = subcomm.allgather(localLength)
-    maxLength = localLength
-    maxLengthRank = subcommRank
-    for i, length in enumerate(ledgerLengths): # compares all ledger lengths
-        if (length > maxLength):
-            maxLength = length
-            maxLengthRank = i
-    needSync = maxLengthRank != subcommRank
-    syncList = subcomm.gather(needSync, 0) # assumes rank 0 always has longest ledger
-    if subcommRank == 0:
-        for i, sync in enumerate(syncList):
-            if sync is True: # sending ledger to nodes with different length
-                subcomm.send(blockchain, i, tag=BC_TAG)
-    if needSync:
-        blockchain = subcomm.recv(source=0, tag=BC_TAG)
-        blockchain.persist()
-    subcomm.barrier()
+    # every node learns the longest ledger and its owner (lowest rank on ties)
+    longestLedger = np.empty(2, 'i4')
+    Comms.subcomm.Allreduce([np.array([localLength, subcommRank], 'i4'), MPI.INT_INT],
+                            [longestLedger, MPI.INT_INT], op=MPI.MAXLOC)
+    maxLength, maxLengthRank = longestLedger.tolist()
+    minLength = np.empty(1, 'i8')
+    Comms.subcomm.Allreduce([np.array([localLength], 'i8'), MPI.INT64_T], [minLength, MPI.INT64_T], op=MPI.MIN)
+    if minLength[0] < maxLength:
+        longest = Comms.subcomm.bcast(blockchain if subcommRank == maxLengthRank else None, root=maxLengthRank)
+        if localLength < maxLength:
+            blockchain = longest
+            blockchain.persist()
 
 
 def make_folders(numBlockchains):
@@ -470,34 +677,105 @@ def make_folders(numBlockchains):
         except OSError as e:
             pass
 
-def create_subcomm(numBlockchains):
-    """Creates subcommunications for the individual blockchains"""
-    """Can be extended to take number of blockchains to run from CLA"""
-    color = rank % numBlockchains
-    return comm.Split(color, rank), color
+class Comms:
+    """
+    Class holding the communicators every collective in this module goes through
+
+    Attributes
+    ----------
+    subcomm : Intracomm
+        all nodes of this node's blockchain
+    nodecomm : Intracomm
+        the blockchain's nodes running on the same host
+    leadercomm : Intracomm
+        the lowest ranked node of each host, COMM_NULL on every other node
+
+    Methods
+    -------
+    create(numBlockchains)
+        Splits COMM_WORLD into the blockchain communicators and returns the blockchain's color
+    free()
+        Frees all communicators
+    """
+
+    subcomm = MPI.COMM_NULL
+    nodecomm = MPI.COMM_NULL
+    leadercomm = MPI.COMM_NULL
+
+    @classmethod
+    def create(cls, numBlockchains) -> int:
+        """
+        Creates the communicators once per run so repeated collectives reuse them
+        """
+        color = rank % numBlockchains
+        cls.subcomm = comm.Split(color, rank)
+        # blockchain nodes sharing a host, plus one leader (the lowest rank) per host
+        cls.nodecomm = cls.subcomm.Split_type(MPI.COMM_TYPE_SHARED, key=cls.subcomm.Get_rank())
+        isLeader = cls.nodecomm.Get_rank() == 0
+        cls.leadercomm = cls.subcomm.Split(0 if isLeader else MPI.UNDEFINED, cls.subcomm.Get_rank())
+        return color
+
+    @classmethod
+    def free(cls) -> None:
+        for communicator in (cls.leadercomm, cls.nodecomm, cls.subcomm):
+            if communicator != MPI.COMM_NULL:
+                communicator.Free()
+        cls.subcomm = cls.nodecomm = cls.leadercomm = MPI.COMM_NULL
+
+
+def node_bcast(obj):
+    """
+    Broadcasts an object from subcomm rank 0 to every blockchain node
+    The object is pickled once, sent between hosts through leadercomm and then within each host
+    through nodecomm, so each host receives a single copy over the network
+    """
+    size = np.zeros(1, 'i8')
+    if subcommRank == 0:
+        data = pickle.dumps(obj, protocol=5)
+        size[0] = len(data)
+    if Comms.leadercomm != MPI.COMM_NULL:
+        Comms.leadercomm.Bcast([size, MPI.INT64_T], root=0)
+    Comms.nodecomm.Bcast([size, MPI.INT64_T], root=0)
+    if subcommRank != 0:
+        data = bytearray(int(size[0]))
+    if Comms.leadercomm != MPI.COMM_NULL:
+        Comms.leadercomm.Bcast([data, MPI.BYTE], root=0)
+    Comms.nodecomm.Bcast([data, MPI.BYTE], root=0)
+    if subcommRank == 0:
+        return obj
+    return pickle.loads(data)
 
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
-subcomm, color = create_subcomm(numBlockchains=3)
+numBlockchains = read_num_blockchains()
+# an invalid #blockchains still needs communicators until main prints the usage line
+color = Comms.create(numBlockchains or 1)
 comm.barrier()
-subcommRank = subcomm.Get_rank()
+subcommRank = Comms.subcomm.Get_rank()
 commSize = comm.Get_size()
-subcommSize = subcomm.Get_size()
+subcommSize = Comms.subcomm.Get_size()
 
 memPool = MemPool()
 blockchain = Blockchain()
-if rank == 0:
-    make_folders(numBlockchains=3)
+if rank == 0 and numBlockchains is not None:
+    make_folders(numBlockchains)
 blockchain_file_name = sys.argv[0].rsplit('.')[0]+'/blockchain_'+str(color)+'/miner_'
 # file names: "miner_globalrank_subcommrank"
 blockchain_data = blockchain_file_name + str(rank) + '_' + str(subcommRank) + '.txt'
 blockchain_json = blockchain_file_name + str(rank) + '_' + str(subcommRank) + '.json'
 client_data = 'client_data.txt'
+# append handle shared by persist_block calls, closed at exit
+blockchain_file = None
+PERSIST_FLUSH = 16
+atexit.register(close_blockchain_file)
 clientList = []
-# comm message tags
-BLOCK_TAG = 0
-NONCE_TAG = 1
-BC_TAG = 2
+# fewest clients for which create_clients forks key generation workers; every blockchain's rank 0
+#   does this at once, while the other ranks wait in node_bcast
+PARALLEL_CLIENTS = 256
+# number of nonces each node hashes between elections of a mining winner
+NONCE_CHUNK = 4096
+# receives the winning hex digest, which is always 64 ASCII characters
+_nonce_buf = np.empty(64, 'u1')
 
 # log = logging.getLogger(__name__)
 
@@ -507,33 +785,42 @@ def main():
     global clientList
 
     if (check_cla() is False):
-        print ("Proper format: mpirun -np <#nodes> python3 multiblockchainDP.py #clients #transactions")
+        print ("Proper format: mpirun -np <#nodes> python3 multiblockchainDP.py #clients #transactions [#blockchains]")
+    elif int(sys.argv[2]) > 0 and int(sys.argv[1]) < 2:
+        # every rank sees the same arguments, so they all stop here together
+        if rank == 0:
+            print ("At least 2 clients are needed for transactions, so that sender and recipient differ")
     else:
         blockchain.read_blockchain(blockchain_data)
         synchronize_ledgers()
         numClients = sys.argv[1]
         numTransactions = int(sys.argv[2])
         if subcommRank == 0:
-            # iterates over the number of clients and adds unique clients to a list
-            for x in range(int(numClients)):
-                clientList.append(Client(x))
-            # iterates over number of transactions to create transactions without \
-            #   sender and recipient being the same client
-            for x in range(numTransactions):
-                sender = random.choice(clientList)
-                recipient = random.choice(clientList)
-                while (sender == recipient):
-                    recipient = random.choice(clientList)
-                if color == 0:
-                    function = random.randrange(1,10)
-                elif color == 1:
-                    function = random.getrandbits(1)
-                elif color == 2:
-                    function = random.random()
-                memPool.add_transaction(Transaction(sender, recipient, function))
-        clientList = subcomm.bcast(clientList, root=0)
-        memPool = subcomm.bcast(memPool, root=0)
-        subcomm.barrier()
+            # creates the unique clients, generating their keys in parallel
+            clientList = create_clients(int(numClients))
+            if numTransactions > 0:
+                # draws every sender, recipient and value at once; offsetting the recipient by
+                #   1..n-1 keeps it from ever being the sender
+                rng = np.random.default_rng()
+                n = len(clientList)
+                senders = rng.integers(0, n, numTransactions)
+                recipients = (senders + rng.integers(1, n, numTransactions)) % n
+                # the value type cycles through int, bool and float across blockchains
+                if color % 3 == 0:
+                    functions = rng.integers(1, 10, numTransactions)
+                elif color % 3 == 1:
+                    functions = rng.integers(0, 2, numTransactions)
+                elif color % 3 == 2:
+                    functions = rng.random(numTransactions)
+                # tolist() hands Transaction plain Python values rather than numpy scalars
+                for s, r, function in zip(senders.tolist(), recipients.tolist(), functions.tolist()):
+                    memPool.add_transaction(Transaction(clientList[s], clientList[r], function))
+        # only rank 0 creates and signs transactions, so the others just need public keys
+        publicList = node_bcast([client.to_public() for client in clientList])
+        if subcommRank != 0:
+            clientList = publicList
+        memPool = node_bcast(memPool)
+        Comms.subcomm.barrier()
         # mines blocks until no remaining transactions
         while memPool.get_size() > 0:
             newBlock = Block()
@@ -542,10 +829,12 @@ def main():
                 forRange = memPool.get_size()
             for i in range(forRange):
                 newBlock.add_transaction(memPool.pull_transaction())
-            newBlock.nonce, minedLocal = Miner.mine(newBlock, difficulty=5)
-            Miner.broadcast_block(newBlock, minedLocal)
+            newBlock.previous_block_hash = blockchain.get_last_hash()
+            newBlock.nonce, minerRank = Miner.mine(newBlock, difficulty=5)
+            Miner.broadcast_block(newBlock, minerRank)
+        close_blockchain_file()
         persist_to_json(blockchain.to_dict())
-        subcomm.Free()
+        Comms.free()
 
 
 if __name__ == '__main__':
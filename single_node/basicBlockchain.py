@@ -9,9 +9,6 @@ import random
 import string
 import json
 import binascii
-import numpy as np
-import pandas as pd
-import pylab as pl
 import logging
 import datetime
 import collections
@@ -22,10 +19,13 @@ from Crypto.PublicKey import RSA
 from Crypto.Signature import PKCS1_v1_5
 from os.path import exists
 
+# one random generator shared by every client's key generation
+_RNG = Crypto.Random.new()
+
+
 class Client:
     def __init__(self, name):
-        random = Crypto.Random.new().read
-        self._private_key = RSA.generate(1024, random)
+        self._private_key = RSA.generate(1024, _RNG.read)
         self._public_key = self._private_key.publickey()
         self._signer = PKCS1_v1_5.new(self._private_key)
         self.name = name
@@ -85,7 +85,7 @@ class Transaction:
 # acts as memory pool for transactions before getting added to a block
 class MemPool:
     def __init__(self):
-        self.transactions = []
+        self.transactions = collections.deque()
     def display_mempool(self):
         if len(self.transactions) > 0:
             for transaction in self.transactions:
@@ -95,9 +95,7 @@ class MemPool:
     def add_transaction(self, transaction):
         self.transactions.append(transaction)
     def pull_transaction(self):
-        nextTransaction = self.transactions[0]
-        self.transactions.pop(0)
-        return nextTransaction
+        return self.transactions.popleft()
     def get_size(self):
         return len(self.transactions)
 
@@ -157,12 +155,19 @@ class Miner:
     def mine(message, difficulty = 1):
         # mines a block based on a given difficulty value
         assert difficulty >= 1, "Difficulty is invalid"
-        prefix = '0' * difficulty
+        target = 1 << (256 - 4 * difficulty) # digests below target start with difficulty zeros
+        # hash state after the fixed part of every hashed message, copied for each nonce
+        midstate = hashlib.sha256(str(hash(message)).encode('ascii'))
+        nonce = bytearray(b'0') # ASCII decimal nonce, updated in place
         for i in range(10000):
-            digest = sha256(str(hash(message)) + str(i))
-            if (digest.startswith(prefix)):
+            h = midstate.copy()
+            h.update(nonce)
+            digest = h.digest()
+            if int.from_bytes(digest, 'big') < target:
+                digest = digest.hex()
                 # print ("after " + str(i) + " iterations found nonce: " + digest)
                 return digest
+            increment_nonce(nonce)
 
 
 memPool = MemPool()
@@ -281,8 +286,16 @@ def read_clients(client_data):
                     clientList.append(client)
     return clientList
 
-def sha256(message):
-    return hashlib.sha256(message.encode('ascii')).hexdigest()
+def increment_nonce(nonce):
+    # adds one to the ASCII decimal nonce stored in a bytearray without creating new objects
+    i = len(nonce) - 1
+    while i >= 0:
+        if nonce[i] != 0x39: # '9'
+            nonce[i] += 1
+            return
+        nonce[i] = 0x30 # '0'
+        i -= 1
+    nonce.insert(0, 0x31) # '1'
 
 
 if __name__ == "__main__":
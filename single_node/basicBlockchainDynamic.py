@@ -13,6 +13,7 @@ import pandas as pd
 import pylab as pl
 import logging
 import datetime
+import collections
 import Crypto.Random
 import pickle
 import sys
@@ -21,10 +22,13 @@ from Crypto.PublicKey import RSA
 from Crypto.Signature import PKCS1_v1_5
 from os.path import exists
 
+# one random generator shared by every client's key generation
+_RNG = Crypto.Random.new()
+
+
 class Client:
     def __init__(self, name):
-        random = Crypto.Random.new().read
-        self._private_key = RSA.generate(1024, random)
+        self._private_key = RSA.generate(1024, _RNG.read)
         self._public_key = self._private_key.publickey()
         self._signer = PKCS1_v1_5.new(self._private_key)
         self.name = name
@@ -80,7 +84,7 @@ class Transaction:
 # acts as memory pool for transactions before getting added to a block
 class MemPool:
     def __init__(self):
-        self.transactions = []
+        self.transactions = collections.deque()
     def display_mempool(self):
         if len(self.transactions) > 0:
             for transaction in self.transactions:
@@ -90,9 +94,7 @@ class MemPool:
     def add_transaction(self, transaction):
         self.transactions.append(transaction)
     def pull_transaction(self):
-        nextTransaction = self.transactions[0]
-        self.transactions.pop(0)
-        return nextTransaction
+        return self.transactions.popleft()
     def get_size(self):
         return len(self.transactions)
 
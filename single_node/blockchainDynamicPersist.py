@@ -4,48 +4,62 @@ Description: Script for running user-defined number of transactions and clients
 
 
 import hashlib
-import random
 import string
-import json
-import binascii
-import numpy as np
-import pandas as pd
-import pylab as pl
+import orjson
 import logging
 import datetime
-import Crypto.Random
+import collections
+import concurrent.futures
+import itertools
+import multiprocessing
+import os
+import nacl.exceptions
+import nacl.signing
 import pickle
+import struct
 import sys
-from Crypto.Hash import SHA
-from Crypto.PublicKey import RSA
-from Crypto.Signature import PKCS1_v1_5
+from multiprocessing.pool import ThreadPool
 from os.path import exists
 
 class Client:
     def __init__(self, name):
-        random = Crypto.Random.new().read
-        self._private_key = RSA.generate(1024, random)
-        self._public_key = self._private_key.publickey()
-        self._signer = PKCS1_v1_5.new(self._private_key)
+        # Ed25519 keys are generated and used by libsodium, far faster than RSA
+        self._signing_key = nacl.signing.SigningKey.generate()
+        # the public key never changes, so it is encoded once instead of on every access
+        self.identity = bytes(self._signing_key.verify_key).hex()
         self.name = name
     
     def sign(self):
-        return self._private_key
-
-    @property
-    def identity(self):
-        return binascii.hexlify(self._public_key.exportKey(format='DER')).decode('ascii')
+        return self._signing_key
     
     def __eq__ (self, name):
         return self.name == name
 
 
 class Transaction:
+    # no per-instance __dict__; transactions are the most numerous objects in a run
+    __slots__ = ('sender', 'recipient', 'value', 'time', '_canonical', '_hash', 'signature')
+
     def __init__(self, sender, recipient, value):
         self.sender = sender
         self.recipient = recipient
         self.value = value
         self.time = datetime.datetime.now()
+        self.signature = None
+        self._set_canonical()
+
+    def _set_canonical(self):
+        # fixed serialization and digest of the transaction, computed once for signing and hashing
+        self._canonical = self._encode_fields()
+        self._hash = hashlib.sha256(self._canonical).digest()
+
+    def _encode_fields(self):
+        return (f"{self.sender.name}|{self.recipient.name}|{self.value}|"
+                f"{self.time.isoformat()}").encode('ascii')
+
+    def matches_canonical(self):
+        # False when the fields no longer describe the transaction that was signed and hashed
+        return self._canonical == self._encode_fields()
 
     def to_dict(self):
 
@@ -57,66 +71,104 @@ class Transaction:
         }
 
     def sign_transaction(self, signer):
-        # uses sender's private key to sign transaction
+        # uses sender's signing key to sign transaction
         if (signer.sign() == self.sender.sign()):
-            private_key = self.sender._private_key
-            signer = PKCS1_v1_5.new(private_key)
-            h = SHA.new(str(self.to_dict()).encode('utf8'))
-            return binascii.hexlify(signer.sign(h)).decode('ascii')
+            return self.sender._signing_key.sign(self.to_bytes()).signature.hex()
+
+    def to_bytes(self):
+        # the message covered by the signature
+        return self._canonical
+
+    def __setstate__(self, state):
+        restore_slots(self, state)
+        # transactions saved before the canonical bytes existed are rebuilt from their fields
+        if not hasattr(self, '_canonical'):
+            self._set_canonical()
+        if not hasattr(self, 'signature'):
+            self.signature = None
+
+    def format_transaction(self):
+        return (f"Transaction Data\n"
+                f"----------------\n"
+                f"sender: {self.sender.name}\n"
+                f"-----\n"
+                f"recipient: {self.recipient.name}\n"
+                f"-----\n"
+                f"value: {self.value}\n"
+                f"-----\n"
+                f"time: {self.time}\n"
+                f"-----\n")
 
     def display_transaction(self):
-        dict = self.to_dict()
-        print ("Transaction Data")
-        print ('----------------')
-        print ("sender: " + dict['sender'])
-        print ('-----')
-        print ("recipient: " + dict['recipient'])
-        print ('-----')
-        print ("value: " + str(dict['value']))
-        print ('-----')
-        print ("time: " + str(dict['time']))
-        print ('-----')
+        # one write per transaction rather than one print per line
+        sys.stdout.write(self.format_transaction())
 
 
 # acts as memory pool for transactions before getting added to a block
 class MemPool:
     def __init__(self):
-        self.transactions = []
+        self.transactions = collections.deque()
     def display_mempool(self):
         if len(self.transactions) > 0:
-            for transaction in self.transactions:
-                transaction.display_transaction()
+            sys.stdout.write(''.join(transaction.format_transaction() for transaction in self.transactions))
         else:
             print ("Mem Pool is empty")
     def add_transaction(self, transaction):
         self.transactions.append(transaction)
     def pull_transaction(self):
-        nextTransaction = self.transactions[0]
-        self.transactions.pop(0)
-        return nextTransaction
+        return self.transactions.popleft()
     def get_size(self):
         return len(self.transactions)
 
 
 # ensapsulates transactions to be added to blockchain
 class Block:
+    __slots__ = ('verified_transactions', 'previous_block_hash', 'Nonce', 'blockHeight', 'merkle_root')
     def __init__(self):
         self.verified_transactions = []
         self.previous_block_hash = ""
         self.Nonce = ""
         self.blockHeight = 0
+        self.merkle_root = b''
+    def __setstate__(self, state):
+        restore_slots(self, state)
+        # blocks saved before merkle roots existed
+        if not hasattr(self, 'merkle_root'):
+            self.merkle_root = merkle_root([transaction._hash for transaction in self.verified_transactions])
+    def format_block(self):
+        return (f"Block #{self.blockHeight}\n--------\n"
+                + ''.join(transaction.format_transaction() for transaction in self.verified_transactions))
     def display_block(self):
-        print ("Block #" + str(self.blockHeight))
-        print ("--------")
-        for transaction in self.verified_transactions:
-            transaction.display_transaction()
+        sys.stdout.write(self.format_block())
     def add_transaction(self, transaction):
         self.verified_transactions.append(transaction)
-    def to_dict(self) -> dict:
-        returnDict = {}
-        for x, transaction in enumerate(self.verified_transactions):
-            returnDict[x] = transaction.to_dict()
-        return returnDict
+    def verify_transactions_batch(self, pool=None):
+        # verifies every transaction signature in the block in one call, in parallel if given a pool
+        # verify keys are built once per sender rather than once per transaction
+        verifyKeys = {}
+        signatures = []
+        for transaction in self.verified_transactions:
+            if transaction.signature is None:
+                return False
+            identity = transaction.sender.identity
+            if identity not in verifyKeys:
+                verifyKeys[identity] = nacl.signing.VerifyKey(bytes.fromhex(identity))
+            signatures.append((verifyKeys[identity], transaction.to_bytes(),
+                               bytes.fromhex(transaction.signature)))
+        if pool is None:
+            return all(map(verify_signature, signatures))
+        return all(pool.map(verify_signature, signatures))
+    def compute_hash(self):
+        # content hash linking the block to its predecessor; unlike hash(), it is the same across runs
+        # the transactions enter through their merkle root, so the block hash is fixed-size input
+        self.merkle_root = merkle_root([transaction._hash for transaction in self.verified_transactions])
+        h = hashlib.sha256(self.previous_block_hash.encode('ascii'))
+        h.update(self.merkle_root)
+        h.update(str(self.Nonce).encode('ascii'))
+        return h.hexdigest()
+    def to_dict(self) -> list:
+        # a transaction's position in the list is its index in the block
+        return [transaction.to_dict() for transaction in self.verified_transactions]
 
 
 # contains record of all transactions made
@@ -128,71 +180,176 @@ class Blockchain:
         self.difficulty = 2
     def add_block(self, newBlock, fromFile):
         # appends a block to the blockchain
+        # blocks read from file already carry the hash of their predecessor
+        if fromFile is False:
+            newBlock.previous_block_hash = self.latestBlockHash
+        self._append_block_no_persist(newBlock)
+        if fromFile is False:
+            persist_block(newBlock)
+    def _append_block_no_persist(self, newBlock):
+        # links a block into the chain without writing it to the blockchain file
         self.chain.append(newBlock)
-        self.latestBlockHash = hash(newBlock)
+        self.latestBlockHash = newBlock.compute_hash()
         self.chainLength += 1
         newBlock.blockHeight = self.chainLength
-        if fromFile is False:
-            persist_block(newBlock)
         # maybe add logic to check hashes (verify before adding?)
     def get_chain_length(self):
         return self.chainLength
     def get_last_hash(self):
         return self.latestBlockHash
     def display_chain(self):
-        print ("Number of blocks: " + str(self.get_chain_length()))
-        for block in self.chain:
-            print("========================")
-            block.display_block()
+        # the whole chain is built into one string and written at once
+        sys.stdout.write(f"Number of blocks: {self.get_chain_length()}\n"
+                         + ''.join(f"========================\n{block.format_block()}" for block in self.chain))
     def verify_chain(self):
-        # iterates over the blockchain from genesis to latest and checks hashes
+        # iterates over the blockchain from genesis to latest and checks hashes and signatures
         for i in range(0, self.chainLength-1):
-            if (hash(self.chain[i]) != self.chain[i+1].previous_block_hash):
+            if (self.chain[i].compute_hash() != self.chain[i+1].previous_block_hash):
                 return False
-        return True
+        # libsodium releases the GIL, so a thread pool verifies signatures in parallel
+        with ThreadPool() as pool:
+            return all(block.verify_transactions_batch(pool) for block in self.chain)
     def read_blockchain(self, blockchain_data):
     # reads pickled blocks if there are existing data
         if exists(blockchain_data):
+            # reads the blocks back in a single pass until the end of the file
+            # each block was dumped as its own pickle, so each needs a fresh unpickler: memo
+            #   indices restart in every stream and a shared memo would hand out earlier blocks' objects
             with open(blockchain_data, 'rb') as file:
-                i = 0
-                while i < 5:
+                while True:
                     try:
                         block = pickle.load(file)
                     except EOFError:
                         break
                     else:
-                        self.add_block(block, True)
+                        if not all(transaction.matches_canonical() for transaction in block.verified_transactions):
+                            raise ValueError(f"Block #{self.chainLength + 1} in {blockchain_data} does not match "
+                                             f"its transactions' signed data")
+                        self._append_block_no_persist(block)
         else:
             print ("No prior blockchain data found")
-    def to_dict(self) -> dict:
-        returnDict = {}
-        for x, block in enumerate(self.chain):
-            returnDict[x] = block.to_dict()
-        return returnDict
+    def to_dict(self) -> list:
+        # a block's position in the list is its index in the chain
+        return [block.to_dict() for block in self.chain]
 
 
 class Miner:
     def __init__(self) -> None:
         self.client = Client()
-    def mine(message, difficulty = 1):
-        # mines a block based on a given difficulty value
+    def mine(message, difficulty = 1, executor = None):
+        # mines a block based on a given difficulty value, searching NONCE_CHUNK nonces at a time
+        #   until a digest is found
+        # with an executor, each of its workers searches its own chunk and is handed the next
+        #   unsearched chunk when it finishes without a digest
         assert difficulty >= 1, "Difficulty is invalid"
-        prefix = '0' * difficulty
-        for i in range(10000):
-            digest = sha256(str(hash(message)) + str(i))
-            if (digest.startswith(prefix)):
-                # print ("after " + str(i) + " iterations found nonce: " + digest)
-                return digest
+        prefix = str(hash(message)).encode('ascii')
+        nonceFound.clear()
+        starts = itertools.count(0, NONCE_CHUNK)
+        if executor is None:
+            for start in starts:
+                digest = search_nonces(prefix, start, start + NONCE_CHUNK, difficulty)
+                if digest is not None:
+                    return digest
+        pending = {executor.submit(search_nonces, prefix, start, start + NONCE_CHUNK, difficulty)
+                   for start in itertools.islice(starts, MINING_WORKERS)}
+        digest = None
+        while digest is None:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.result() is not None:
+                    digest = future.result()
+                elif digest is None:
+                    start = next(starts)
+                    pending.add(executor.submit(search_nonces, prefix, start, start + NONCE_CHUNK, difficulty))
+        # the other workers stop at their next check of nonceFound
+        concurrent.futures.wait(pending)
+        return digest
+
+
+def search_nonces(prefix, start, stop, difficulty):
+    # hashes the nonces in [start, stop), both multiples of FOUND_CHECK, after prefix and returns
+    #   the first qualifying hex digest
+    # gives up early, returning None, once any search has set nonceFound
+    # a digest starts with difficulty hex zeros when its first difficulty//2 bytes are zero and,
+    #   for an odd difficulty, the following byte is below 16
+    zeroBytes = bytes(difficulty // 2)
+    halfByte = difficulty // 2 if difficulty % 2 else None
+    # a nonce is the 8 byte number of its batch of FOUND_CHECK nonces followed by one byte from
+    #   NONCE_SUFFIXES; the prefix is absorbed once and each batch number once per batch, and the
+    #   whole input stays within a single 64 byte SHA-256 block
+    base = hashlib.sha256(prefix)
+    for batch in range(start // FOUND_CHECK, stop // FOUND_CHECK):
+        if nonceFound.is_set():
+            return None
+        batchState = base.copy()
+        batchState.update(BATCH_NUMBER.pack(batch))
+        copy = batchState.copy # bound once, the loop body is almost all per-call overhead
+        for suffix in NONCE_SUFFIXES:
+            h = copy()
+            h.update(suffix)
+            digest = h.digest()
+            if digest.startswith(zeroBytes) and (halfByte is None or digest[halfByte] < 16):
+                nonceFound.set()
+                return digest.hex()
+    return None
+
+
+def merkle_root(leaves):
+    # hashes the leaf digests pairwise, level by level, down to a single 32-byte root
+    # a level with an odd count carries its last digest up unpaired; pairing it with itself would
+    #   give [t1, t2, t3] and [t1, t2, t3, t3] the same root (CVE-2012-2459)
+    if not leaves:
+        return hashlib.sha256(b'').digest()
+    level = leaves
+    while len(level) > 1:
+        paired = [hashlib.sha256(level[i] + level[i+1]).digest() for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            paired.append(level[-1])
+        level = paired
+    return level[0]
+
+
+def restore_slots(obj, state):
+    # copies the saved attributes from either slotted state or the plain __dict__ pickled
+    #   before __slots__; each class's __setstate__ then rebuilds the derived attributes
+    if isinstance(state, tuple):
+        state = state[1]
+    for key, value in state.items():
+        if key in type(obj).__slots__:
+            setattr(obj, key, value)
+
+
+def init_miner(event):
+    # runs in each mining worker so all searches share the parent's nonceFound event
+    global nonceFound
+    nonceFound = event
+
+
+def verify_signature(signature):
+    # checks one (verify key, message, signature) tuple
+    verifyKey, message, signed = signature
+    try:
+        verifyKey.verify(message, signed)
+    except nacl.exceptions.BadSignatureError:
+        return False
+    return True
+
+
+def write_json_block(file, block, first):
+    # appends one block to the json array being written to file
+    if not first:
+        file.write(b',')
+    file.write(b'\n')
+    file.write(orjson.dumps(block.to_dict(), option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
 
 
 def check_cla() -> bool:
-    return len(sys.argv) == 3
+    return len(sys.argv) in (3, 4)
 
 
 def persist_block(newBlock):
-    # appends a pickled block to file
-    with open(blockchain_data, 'ab') as file:
-        pickle.dump(newBlock, file)
+    # appends a pickled block to the data file main keeps open for the whole run
+    pickle.dump(newBlock, persist_fp, protocol=pickle.HIGHEST_PROTOCOL)
 
 
 def read_clients(client_data):
@@ -210,50 +367,92 @@ def read_clients(client_data):
     return clientList
 
 
-def sha256(message):
-    return hashlib.sha256(message.encode('ascii')).hexdigest()
-
+# set by whichever search finds a digest first; searches check it every FOUND_CHECK nonces
+nonceFound = multiprocessing.Event()
+FOUND_CHECK = 256
+# the last byte of every nonce, encoded once per run; one per nonce in a batch
+NONCE_SUFFIXES = [bytes([i]) for i in range(FOUND_CHECK)]
+BATCH_NUMBER = struct.Struct('<Q')
+# nonces a single search covers before Miner.mine hands out the next range
+NONCE_CHUNK = 1 << 20
+# a block takes about 16**difficulty hashes; from 5 on that is at least one NONCE_CHUNK, so
+#   mining uses worker processes (when there is more than one CPU)
+PARALLEL_DIFFICULTY = 5
+MINING_WORKERS = os.cpu_count()
+# fewest clients for which generating keys in worker processes beats the pool startup
+#   an Ed25519 keypair takes tens of microseconds, so small runs stay serial
+PARALLEL_CLIENTS = 10000
 
 memPool = MemPool()
 blockchain = Blockchain()
 blockchain_data = 'blockchain_data_DP.txt'
 client_data = 'client_data_DP.txt'
 json_file = 'output_DP.json'
+persist_fp = None
 
 def main():
+    global persist_fp
     if (check_cla() is False):
-        print ("Proper format: python3 BasicBlockchainDynamic.py #clients #transactions")
+        print ("Proper format: python3 blockchainDynamicPersist.py #clients #transactions [#difficulty]")
+    elif len(sys.argv) == 4 and int(sys.argv[3]) < 1:
+        print ("Difficulty must be at least 1")
+    elif int(sys.argv[2]) > 0 and int(sys.argv[1]) < 2:
+        print ("At least 2 clients are needed for transactions, so that sender and recipient differ")
     else:
         blockchain.read_blockchain(blockchain_data)
-        clientList = []
-        numClients = sys.argv[1]
+        persist_fp = open(blockchain_data, 'ab')
+        numClients = int(sys.argv[1])
         numTransactions = int(sys.argv[2])
-
-        # iterates over the number of clients and adds unique clients to a list
-        for x in range(int(numClients)):
-            clientList.append(Client(x))
-        # iterates over number of transactions to create transactions without \
-        #   sender and recipient being the same client
-        for x in range(numTransactions):
-            sender = random.choice(clientList)
-            recipient = random.choice(clientList)
-            while (sender == recipient):
-                recipient = random.choice(clientList)
-            memPool.add_transaction(Transaction(sender, recipient, 1))
-        # mines blocks until no remaining transactions
-        while memPool.get_size() > 0:
-            newBlock = Block()
-            forRange = 3 # determines max number of transactions/block
-            if memPool.get_size() < forRange:
-                forRange = memPool.get_size()
-            for i in range(forRange):
-                newBlock.add_transaction(memPool.pull_transaction())
-            newBlock.nonce = Miner.mine(newBlock, difficulty=2)
-            blockchain.add_block(newBlock, False)
-        # converts blockchain to json object for file output
-        json_object = json.dumps(blockchain.to_dict(), indent=4, sort_keys=True, default=str)
-        with open(json_file, 'w') as file:
-            file.write(json_object)
+        if len(sys.argv) == 4:
+            blockchain.difficulty = int(sys.argv[3])
+
+        # creates a list of numClients unique clients
+        if numClients >= PARALLEL_CLIENTS:
+            # clients are independent, so whole chunks of them are generated per worker
+            with concurrent.futures.ProcessPoolExecutor() as clientExecutor:
+                clientList = list(clientExecutor.map(Client, range(numClients),
+                                                     chunksize=max(1, numClients // (4 * os.cpu_count()))))
+        else:
+            clientList = [Client(x) for x in range(numClients)]
+        if numTransactions > 0:
+            # numpy is only needed to draw transactions, so runs without any never load it
+            import numpy as np
+            # draws every sender and recipient index at once; offsetting the recipient by 1..n-1
+            #   keeps it from being the sender without retrying
+            rng = np.random.default_rng()
+            n = len(clientList)
+            senders = rng.integers(0, n, numTransactions)
+            recipients = (senders + rng.integers(1, n, numTransactions)) % n
+            for i, j in zip(senders.tolist(), recipients.tolist()):
+                sender, recipient = clientList[i], clientList[j]
+                transaction = Transaction(sender, recipient, 1)
+                transaction.signature = transaction.sign_transaction(sender)
+                memPool.add_transaction(transaction)
+        executor = None
+        if blockchain.difficulty >= PARALLEL_DIFFICULTY and MINING_WORKERS > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=MINING_WORKERS,
+                                                              initializer=init_miner,
+                                                              initargs=(nonceFound,))
+        # streams the blockchain to the json file block by block instead of converting it at the end
+        with open(json_file, 'wb') as file:
+            file.write(b'[')
+            for x, block in enumerate(blockchain.chain):
+                write_json_block(file, block, x == 0)
+            # mines blocks until no remaining transactions
+            while memPool.get_size() > 0:
+                newBlock = Block()
+                forRange = 3 # determines max number of transactions/block
+                if memPool.get_size() < forRange:
+                    forRange = memPool.get_size()
+                for i in range(forRange):
+                    newBlock.add_transaction(memPool.pull_transaction())
+                newBlock.Nonce = Miner.mine(newBlock, blockchain.difficulty, executor)
+                blockchain.add_block(newBlock, False)
+                write_json_block(file, newBlock, blockchain.chainLength == 1)
+            file.write(b'\n]\n')
+        if executor is not None:
+            executor.shutdown()
+        persist_fp.close()
         print (f"Size of blockchain: {blockchain.chainLength}")
 
 